@@ -1,10 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+import scipy.sparse as sp
 import properties
 from ....utils.code_utils import deprecate_class
 
 from .... import props
 from ....data import Data
-from ....utils import mkvc, sdiag
+from ....utils import mkvc, sdiag, Zero
 from ...base import BaseEMSimulation
 
 from ..resistivity.fields import FieldsDC, Fields3DCellCentered, Fields3DNodal
@@ -32,10 +35,27 @@ class BaseIPSimulation(BaseEMSimulation):
     Ainv = None
     _f = None
     storeJ = False
+    # Precision of the stored sensitivity, np.float32 halves its footprint
+    jacobian_dtype = np.float64
+    # Columns solved at once: data columns when forming the full sensitivity,
+    # sources in Jvec and Jtvec. Besides the fields (and J), a product then
+    # holds about five dense (nU, max_block_columns) arrays for the right hand
+    # sides, the solution and the solver workspace, whatever the survey size.
+    # Lower it to trade the batching of the solves for memory.
+    max_block_columns = 16
+    # Threads used to assemble the full sensitivity (None or 1: serial). Each
+    # thread holds its own (nModel, nD_src) block on top of the BLAS threads.
+    n_threads = None
+    # A = D MfRhoI G (HJ) and G.T MeSigma G (EB) are symmetric, so the adjoint
+    # solves reuse Ainv. Pinning the null space (EB, or HJ with Neumann BC)
+    # breaks the symmetry of row 0, and the reuse is then an approximation
+    # that holds when the adjoint field near node 0 is negligible (node 0
+    # sits in the padding). Set False to factor A.T for the adjoint solves.
+    A_symmetric = True
+    _ATinv = None
     _Jmatrix = None
     gtgdiag = None
     sign = None
-    _pred = None
     gtgdiag = None
 
     def fields(self, m=None):
@@ -53,6 +73,7 @@ class BaseIPSimulation(BaseEMSimulation):
             self._f = self.fieldsPair(self)
             A = self.getA()
             self.Ainv = self.solver(A, **self.solver_opts)
+            self._ATinv = None
             RHS = self.getRHS()
             Srcs = self.survey.source_list
             self._f[Srcs, self._solutionType] = self.Ainv * RHS
@@ -66,11 +87,6 @@ class BaseIPSimulation(BaseEMSimulation):
                         rx.data_type = self.data_type
                         rx._Ps = {}
 
-        if self.verbose is True:
-            print(">> Compute predicted data")
-
-        self._pred = self.forward(m, f=self._f)
-
         # if not self.storeJ:
         #     self.Ainv.clean()
 
@@ -87,6 +103,21 @@ class BaseIPSimulation(BaseEMSimulation):
         """
         if f is None:
             f = self.fields(m)
+        elif m is not None:
+            self.model = m
+
+        # The predicted data are cached for an exact copy of the model, the
+        # model update skips the invalidation for allclose models
+        pred_model = getattr(self, "_pred_model", None)
+        if (
+            getattr(self, "_pred", None) is None
+            or pred_model is None
+            or not np.array_equal(pred_model, self.model)
+        ):
+            if self.verbose is True:
+                print(">> Compute predicted data")
+            self._pred = self.forward(self.model, f=f)
+            self._pred_model = np.array(self.model, copy=True)
 
         return self._pred
 
@@ -117,39 +148,55 @@ class BaseIPSimulation(BaseEMSimulation):
             Generate Full sensitivity matrix
         """
         if self._Jmatrix is None:
+            if f is None:
+                f = self.fields(m)
             self._Jmatrix = self._Jtvec(m, v=None, f=f).T
         return self._Jmatrix
 
     # @profile
     def Jvec(self, m, v, f=None):
 
-        self.model = m
-
-        if f is None:
-            f = self.fields(m)
+        f = self._get_fields(m, f)
 
         # When sensitivity matrix J is stored
         if self.storeJ:
             J = self.getJ(m, f=f)
-            Jv = J.dot(v)
+            Jv = J.dot(np.ascontiguousarray(v, dtype=J.dtype))
             return self.sign * Jv
-        Jv = []
-
-        for src in self.survey.source_list:
-            # solution vector
-            u_src = f[src, self._solutionType]
-            dA_dm_v = self.getADeriv(u_src.flatten(), v, adjoint=False)
-            dRHS_dm_v = self.getRHSDeriv(src, v)
-            du_dm_v = self.Ainv * (-dA_dm_v + dRHS_dm_v)
 
-            for rx in src.receiver_list:
-                df_dmFun = getattr(f, "_{0!s}Deriv".format(rx.projField), None)
-                df_dm_v = df_dmFun(src, du_dm_v, v, adjoint=False)
-                Jv.append(rx.evalDeriv(src, self.mesh, f, df_dm_v))
+        source_list = self.survey.source_list
+
+        Jv = np.empty(self.survey.nD)
+        istrt = 0
+        # The sources are solved in blocks of at most max_block_columns
+        for i0 in range(0, len(source_list), self.max_block_columns):
+            block = source_list[i0 : i0 + self.max_block_columns]
+            U = self._get_solution(f, slice(i0, i0 + len(block)))
+
+            # right hand sides of the block, solved in a single call
+            RHS = np.empty_like(U)
+            for j, src in enumerate(block):
+                dA_dm_v = self.getADeriv(U[:, j], v, adjoint=False)
+                dRHS_dm_v = self.getRHSDeriv(src, v)
+                RHS[:, j] = -dA_dm_v + dRHS_dm_v
+            dU_dm_v = (self.Ainv * RHS).reshape(RHS.shape, order="F")
+            del RHS, U
+
+            for j, src in enumerate(block):
+                du_dm_v = dU_dm_v[:, j]
+
+                for rx in src.receiver_list:
+                    df_dmFun = getattr(f, "_{0!s}Deriv".format(rx.projField), None)
+                    df_dm_v = df_dmFun(src, du_dm_v, v, adjoint=False)
+                    iend = istrt + rx.nD
+                    Jv[istrt:iend] = rx.evalDeriv(src, self.mesh, f, df_dm_v)
+                    istrt = iend
+            del dU_dm_v
 
         # Conductivity (d u / d log sigma) - EB form
         # Resistivity (d u / d log rho) - HJ form
-        return self.sign * np.hstack(Jv)
+        Jv *= self.sign
+        return Jv
 
     def forward(self, m, f=None):
         return np.asarray(self.Jvec(m, m, f=f))
@@ -159,21 +206,16 @@ class BaseIPSimulation(BaseEMSimulation):
             Compute adjoint sensitivity matrix (J^T) and vector (v) product.
 
         """
-        if f is None:
-            f = self.fields(m)
+        f = self._get_fields(m, f)
 
         # When sensitivity matrix J is stored
         if self.storeJ:
             J = self.getJ(m, f=f)
-            Jtv = np.asarray(J.T.dot(v))
+            # J is C ordered, so J.T is a Fortran ordered view (no copy)
+            Jtv = np.asarray(J.T.dot(np.ascontiguousarray(v, dtype=J.dtype)))
             return self.sign * Jtv
 
-        else:
-            self.model = m
-
-            if f is None:
-                f = self.fields(m)
-            return self._Jtvec(m, v=v, f=f)
+        return self._Jtvec(m, v=v, f=f)
 
     def _Jtvec(self, m, v=None, f=None):
         """
@@ -181,58 +223,189 @@ class BaseIPSimulation(BaseEMSimulation):
             Full J matrix can be computed by inputing v=None
         """
 
-        if v is not None:
-            # Ensure v is a data object.
-            if not isinstance(v, Data):
-                v = Data(self.survey, v)
-            Jtv = np.zeros(m.size)
-        else:
-            # This is for forming full sensitivity matrix
-            Jtv = np.zeros((self.model.size, self.survey.nD), order="F")
-            istrt = int(0)
-            iend = int(0)
-
-        for isrc, src in enumerate(self.survey.source_list):
-            u_src = f[src, self._solutionType]
-            # if self.storeJ:
-            #     # TODO: use logging package
-            #     sys.stdout.write(("\r %d / %d") % (isrc+1, self.survey.nSrc))
-            #     sys.stdout.flush()
-
-            for rx in src.receiver_list:
-                if v is not None:
+        if v is None:
+            return self._Jtmatrix(f)
+
+        # Ensure v is a data object.
+        if not isinstance(v, Data):
+            v = Data(self.survey, v)
+        Jtv = np.zeros(m.size)
+
+        source_list = self.survey.source_list
+
+        # The adjoint is linear in the receiver terms, so they are summed for
+        # each source and the sources are solved in blocks of at most
+        # max_block_columns, one call per block
+        for i0 in range(0, len(source_list), self.max_block_columns):
+            block = source_list[i0 : i0 + self.max_block_columns]
+            U = self._get_solution(f, slice(i0, i0 + len(block)))
+
+            df_duT = np.zeros_like(U)
+            for j, src in enumerate(block):
+                for rx in src.receiver_list:
                     PTv = rx.evalDeriv(
                         src, self.mesh, f, v[src, rx], adjoint=True
                     )  # wrt f, need possibility wrt m
                     df_duTFun = getattr(f, "_{0!s}Deriv".format(rx.projField), None)
-                    df_duT, df_dmT = df_duTFun(src, None, PTv, adjoint=True)
-                    ATinvdf_duT = self.Ainv * df_duT
-                    dA_dmT = self.getADeriv(u_src.flatten(), ATinvdf_duT, adjoint=True)
-                    # dA_dmT = da.from_delayed(dA_dmT, shape=self.model.shape, dtype=float)
-                    dRHS_dmT = self.getRHSDeriv(src, ATinvdf_duT, adjoint=True)
-                    # dRHS_dmT = da.from_delayed(dRHS_dmT, shape=self.model.shape, dtype=float)
-                    du_dmT = -dA_dmT + dRHS_dmT
-                    Jtv += (df_dmT + du_dmT).astype(float)
-                else:
-                    P = rx.getP(self.mesh, rx.projGLoc(f)).toarray()
-                    ATinvdf_duT = self.Ainv * (P.T)
-                    dA_dmT = self.getADeriv(u_src, ATinvdf_duT, adjoint=True)
+                    df_duT_rx, df_dmT = df_duTFun(src, None, PTv, adjoint=True)
+                    df_duT[:, j] += mkvc(df_duT_rx)
+                    if not isinstance(df_dmT, Zero):
+                        Jtv += df_dmT
+            ATinvdf_duT = (self.ATinv * df_duT).reshape(df_duT.shape, order="F")
+            del df_duT
+
+            for j, src in enumerate(block):
+                dA_dmT = self.getADeriv(U[:, j], ATinvdf_duT[:, j], adjoint=True)
+                dRHS_dmT = self.getRHSDeriv(src, ATinvdf_duT[:, j], adjoint=True)
+                # Jtv += du_dmT, accumulated in place
+                Jtv -= dA_dmT
+                if not isinstance(dRHS_dmT, Zero):
+                    Jtv += dRHS_dmT
+            del ATinvdf_duT, U
 
-                    iend = istrt + rx.nD
-                    if rx.nD == 1:
-                        Jtv[:, istrt] = -dA_dmT
-                    else:
-                        Jtv[:, istrt:iend] = -dA_dmT
-                    istrt += rx.nD
+        # Conductivity ((d u / d log sigma).T) - EB form
+        # Resistivity ((d u / d log rho).T) - HJ form
+        Jtv *= self.sign
+        return Jtv
+
+    def _Jtmatrix(self, f):
+        """
+            Form the full transposed sensitivity matrix (nModel, nD).
+            The data are grouped in blocks of at most max_block_columns
+            columns, a source with more data is split over several blocks.
+            The projections of a block are densified and solved with a
+            single multi-RHS call to ATinv, and freed before the next block,
+            so only one dense (nU, max_block_columns) block is alive next to
+            J.
+
+            J is filled as a C ordered (nD, nModel) array, the layout of the
+            J.dot(v) products, and returned as its transpose view, so
+            getJ(m) = _Jtvec(m, v=None).T gets J back without a copy.
+        """
+        source_list = self.survey.source_list
+
+        J = np.zeros(
+            (self.survey.nD, self.model.size), dtype=self.jacobian_dtype, order="C"
+        )
+        if self.survey.nD == 0:
+            return J.T
+
+        # (isrc, istrt, iend, i0) of the data rows istrt:iend of J, rows
+        # i0:i0 + iend - istrt of source isrc, grouped in column blocks. The
+        # data of a source larger than max_block_columns are split in parts.
+        batches = [[]]
+        ncol = 0
+        istrt = 0
+        for isrc, src in enumerate(source_list):
+            for i0 in range(0, src.nD, self.max_block_columns):
+                i1 = min(i0 + self.max_block_columns, src.nD)
+                if batches[-1] and ncol + i1 - i0 > self.max_block_columns:
+                    batches.append([])
+                    ncol = 0
+                batches[-1].append((isrc, istrt + i0, istrt + i1, i0))
+                ncol += i1 - i0
+            istrt += src.nD
+
+        def assemble_source(block, U, isrc0, ATinvdf_duT, icol):
+            isrc, istrt, iend, _ = block
+            dA_dmT = self.getADeriv(
+                U[:, isrc - isrc0],
+                ATinvdf_duT[:, istrt - icol : iend - icol],
+                adjoint=True,
+            )
+            J[istrt:iend, :] = -dA_dmT.T
+
+        executor = None
+        if self.n_threads is not None and self.n_threads > 1:
+            executor = ThreadPoolExecutor(max_workers=self.n_threads)
+
+        try:
+            for ibatch, batch in enumerate(batches):
+                PT = self._getPT(
+                    f,
+                    [
+                        (source_list[isrc], i0, i0 + iend - istrt)
+                        for isrc, istrt, iend, i0 in batch
+                    ],
+                )
+                ATinvdf_duT = (self.ATinv * PT).reshape(PT.shape, order="F")
+                # Only the solution is needed from here on
+                del PT
+
+                # solution vectors of the sources of the batch
+                isrc0 = batch[0][0]
+                U = self._get_solution(f, slice(isrc0, batch[-1][0] + 1))
+                args = (U, isrc0, ATinvdf_duT, batch[0][1])
+                if executor is None:
+                    for block in batch:
+                        assemble_source(block, *args)
+                else:
+                    if ibatch == 0:
+                        # The first source is done serially so the lazily
+                        # built inner product derivatives are cached before
+                        # the threads share them.
+                        assemble_source(batch[0], *args)
+                        batch = batch[1:]
+                    # Each source writes to its own rows of J
+                    list(
+                        executor.map(lambda block: assemble_source(block, *args), batch)
+                    )
+                del ATinvdf_duT, U, args
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
         # Conductivity ((d u / d log sigma).T) - EB form
         # Resistivity ((d u / d log rho).T) - HJ form
+        return J.T
 
-        if v is not None:
-            return self.sign * mkvc(Jtv)
-        else:
-            return Jtv
-        return
+    def _get_fields(self, m, f=None):
+        """
+            Fields at the model m. fields sets the model, so it is only set
+            here when the fields are given.
+        """
+        if f is None:
+            return self.fields(m)
+        self.model = m
+        return f
+
+    def _get_solution(self, f, ind):
+        """
+            Solution vectors (nU, n) of the sources in the slice ind, one
+            contiguous column per source. Only these columns are copied out
+            of the field storage.
+        """
+        return np.asfortranarray(f[ind, self._solutionType])
+
+    @property
+    def ATinv(self):
+        """
+            Solver for the adjoint system A.T. With A_symmetric this is the
+            forward factorization Ainv, so no second factorization is
+            needed.
+        """
+        if self.A_symmetric:
+            return self.Ainv
+        if self._ATinv is None:
+            self._ATinv = self.solver(self.getA().T, **self.solver_opts)
+        return self._ATinv
+
+    def _getPT(self, f, parts):
+        """
+            Dense transposed projections (nU, nD) of the data rows i0:i1 of
+            the sources in parts = [(src, i0, i1), ...].
+        """
+        # Stack the sparse projections first so the many small (often
+        # single datum) receivers are densified in one pass
+        P = sp.vstack(
+            [
+                sp.vstack(
+                    [rx.getP(self.mesh, rx.projGLoc(f)) for rx in src.receiver_list]
+                ).tocsr()[i0:i1]
+                for src, i0, i1 in parts
+            ]
+        )
+        return P.T.toarray(order="F")
 
     def getSourceTerm(self):
         """
@@ -254,10 +427,12 @@ class BaseIPSimulation(BaseEMSimulation):
         elif self._formulation == "HJ":
             n = self.mesh.nC
 
-        q = np.zeros((n, len(Srcs)))
+        # Fortran ordered so each source is a contiguous column for Ainv
+        q = np.zeros((n, len(Srcs)), order="F")
 
         for i, src in enumerate(Srcs):
             q[:, i] = src.eval(self)
+
         return q
 
     def delete_these_for_sensitivity(self):
@@ -265,42 +440,106 @@ class BaseIPSimulation(BaseEMSimulation):
 
     @property
     def deleteTheseOnModelUpdate(self):
-        toDelete = []
+        # the model-independent inner product bases are kept
+        toDelete = [
+            "_pred",
+            "_pred_model",
+            "_drho_dlogrho",
+            "_dsigma_dlogsigma",
+            "_MfRhoDerivMat",
+            "_MeSigmaDerivMat",
+        ]
         return toDelete
 
+    @property
+    def _clear_on_sigma_update(self):
+        return super(BaseIPSimulation, self)._clear_on_sigma_update + [
+            "_MfRhoI_diag",
+            "_drho_dlogrho",
+            "_dsigma_dlogsigma",
+            "_MfRhoDerivMat",
+            "_MeSigmaDerivMat",
+        ]
+
+    @property
+    def drho_dlogrho(self):
+        """
+        Derivative of rho with respect to the model, scaled by rho
+        """
+        if getattr(self, "_drho_dlogrho", None) is None:
+            self._drho_dlogrho = sdiag(self.rho) * self.etaDeriv
+        return self._drho_dlogrho
+
+    @property
+    def dsigma_dlogsigma(self):
+        """
+        Derivative of sigma with respect to the model, scaled by sigma
+        """
+        if getattr(self, "_dsigma_dlogsigma", None) is None:
+            self._dsigma_dlogsigma = sdiag(self.sigma) * self.etaDeriv
+        return self._dsigma_dlogsigma
+
+    @property
+    def MfRhoBase(self):
+        """
+        Face inner product derivative for a unit resistivity. Only depends on
+        the mesh.
+        """
+        if getattr(self, "_MfRhoBase", None) is None:
+            self._MfRhoBase = self.mesh.getFaceInnerProductDeriv(
+                np.ones(self.mesh.nC)
+            )(np.ones(self.mesh.nF))
+        return self._MfRhoBase
+
     @property
     def MfRhoDerivMat(self):
         """
         Derivative of MfRho with respect to the model
         """
         if getattr(self, "_MfRhoDerivMat", None) is None:
-            drho_dlogrho = sdiag(self.rho) * self.etaDeriv
-            self._MfRhoDerivMat = (
-                self.mesh.getFaceInnerProductDeriv(np.ones(self.mesh.nC))(
-                    np.ones(self.mesh.nF)
-                )
-                * drho_dlogrho
-            )
+            self._MfRhoDerivMat = self.MfRhoBase * self.drho_dlogrho
         return self._MfRhoDerivMat
 
     def MfRhoIDeriv(self, u, v, adjoint=False):
         """
             Derivative of :code:`MfRhoI` with respect to the model.
         """
-        dMfRhoI_dI = -self.MfRhoI ** 2
+        # MfRhoI is diagonal, so is its derivative (and it is symmetric)
+        if getattr(self, "_MfRhoI_diag", None) is None:
+            self._MfRhoI_diag = self.MfRhoI.diagonal()
+        dMfRhoI_dI = -self._MfRhoI_diag ** 2
+        if v.ndim > 1:
+            dMfRhoI_dI = dMfRhoI_dI[:, None]
+
         if self.storeInnerProduct:
+            u = mkvc(u)
+            if v.ndim > 1:
+                # promote u iff v is a matrix
+                u = u[:, None]  # Avoids constructing the sparse matrix
             if adjoint:
-                return self.MfRhoDerivMat.T * (sdiag(u) * (dMfRhoI_dI.T * v))
+                return self.MfRhoDerivMat.T * (u * (dMfRhoI_dI * v))
             else:
-                return dMfRhoI_dI * (sdiag(u) * (self.MfRhoDerivMat * v))
+                return dMfRhoI_dI * (u * (self.MfRhoDerivMat * v))
         else:
             dMf_drho = self.mesh.getFaceInnerProductDeriv(self.rho)(u)
-            drho_dlogrho = sdiag(self.rho) * self.etaDeriv
+            drho_dlogrho = self.drho_dlogrho
             if adjoint:
-                return drho_dlogrho.T * (dMf_drho.T * (dMfRhoI_dI.T * v))
+                return drho_dlogrho.T * (dMf_drho.T * (dMfRhoI_dI * v))
             else:
                 return dMfRhoI_dI * (dMf_drho * (drho_dlogrho * v))
 
+    @property
+    def MeSigmaBase(self):
+        """
+        Edge inner product derivative for a unit conductivity. Only depends on
+        the mesh.
+        """
+        if getattr(self, "_MeSigmaBase", None) is None:
+            self._MeSigmaBase = self.mesh.getEdgeInnerProductDeriv(
+                np.ones(self.mesh.nC)
+            )(np.ones(self.mesh.nE))
+        return self._MeSigmaBase
+
     @property
     def MeSigmaDerivMat(self):
         """
@@ -308,13 +547,7 @@ class BaseIPSimulation(BaseEMSimulation):
         """
 
         if getattr(self, "_MeSigmaDerivMat", None) is None:
-            dsigma_dlogsigma = sdiag(self.sigma) * self.etaDeriv
-            self._MeSigmaDerivMat = (
-                self.mesh.getEdgeInnerProductDeriv(np.ones(self.mesh.nC))(
-                    np.ones(self.mesh.nE)
-                )
-                * dsigma_dlogsigma
-            )
+            self._MeSigmaDerivMat = self.MeSigmaBase * self.dsigma_dlogsigma
         return self._MeSigmaDerivMat
 
     # TODO: This should take a vector
@@ -323,12 +556,16 @@ class BaseIPSimulation(BaseEMSimulation):
         Derivative of MeSigma with respect to the model times a vector (u)
         """
         if self.storeInnerProduct:
+            u = mkvc(u)
+            if v.ndim > 1:
+                # promote u iff v is a matrix
+                u = u[:, None]  # Avoids constructing the sparse matrix
             if adjoint:
-                return self.MeSigmaDerivMat.T * (sdiag(u) * v)
+                return self.MeSigmaDerivMat.T * (u * v)
             else:
-                return sdiag(u) * (self.MeSigmaDerivMat * v)
+                return u * (self.MeSigmaDerivMat * v)
         else:
-            dsigma_dlogsigma = sdiag(self.sigma) * self.etaDeriv
+            dsigma_dlogsigma = self.dsigma_dlogsigma
             if adjoint:
                 return dsigma_dlogsigma.T * (
                     self.mesh.getEdgeInnerProductDeriv(self.sigma)(u).T * v
@@ -286,9 +286,8 @@ class Simulation3DCellCentered(BaseDCSimulation):
                 print("Perturbing first row of A to remove nullspace for Neumann BC.")
 
             # Handling Null space of A
-            I, J, V = sp.sparse.find(A[0, :])
-            for jj in J:
-                A[0, jj] = 0.0
+            A = A.tocsr()
+            A.data[A.indptr[0] : A.indptr[1]] = 0.0
             A[0, 0] = 1.0
 
         return A
@@ -488,9 +487,8 @@ class Simulation3DNodal(BaseDCSimulation):
         A = Grad.T @ MeSigma @ Grad
 
         # Handling Null space of A
-        I, J, V = sp.sparse.find(A[0, :])
-        for jj in J:
-            A[0, jj] = 0.0
+        A = A.tocsr()
+        A.data[A.indptr[0] : A.indptr[1]] = 0.0
         A[0, 0] = 1.0
 
         return A
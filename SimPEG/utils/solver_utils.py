@@ -64,12 +64,12 @@ def SolverWrapD(fun, factorize=True, checkAccuracy=True, accuracyTol=1e-6, name=
             if b.dtype is np.dtype("O"):
                 b = b.astype(type(b[0, 0]))
 
-            X = np.empty_like(b)
-
-            for i in range(b.shape[1]):
-                if factorize:
-                    X[:, i] = self.solver.solve(b[:, i])
-                else:
+            if factorize:
+                # The factorization solves all the columns in one call
+                X = self.solver.solve(b)
+            else:
+                X = np.empty_like(b)
+                for i in range(b.shape[1]):
                     X[:, i] = fun(self.A, b[:, i], **self.kwargs)
 
         if self.checkAccuracy:
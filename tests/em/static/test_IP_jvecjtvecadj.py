@@ -321,5 +321,167 @@ class IPProblemTestsN_storeJ(unittest.TestCase):
             pass
 
 
+class IPProblemTestsCC_storeJ_float32(unittest.TestCase):
+    def setUp(self):
+
+        aSpacing = 2.5
+        nElecs = 5
+
+        surveySize = nElecs * aSpacing - aSpacing
+        cs = surveySize / nElecs / 4
+
+        mesh = discretize.TensorMesh(
+            [
+                [(cs, 10, -1.3), (cs, surveySize / cs), (cs, 10, 1.3)],
+                [(cs, 3, -1.3), (cs, 3, 1.3)],
+            ],
+            "CN",
+        )
+
+        source_list = dc.utils.WennerSrcList(nElecs, aSpacing, in2D=True)
+        survey = ip.survey.Survey(source_list)
+        sigma = np.ones(mesh.nC)
+        simulation = ip.Simulation3DCellCentered(
+            mesh=mesh,
+            survey=survey,
+            sigma=sigma,
+            etaMap=maps.IdentityMap(mesh),
+            storeJ=True,
+            jacobian_dtype=np.float32,
+        )
+        mSynth = np.ones(mesh.nC) * 0.1
+        dobs = simulation.make_synthetic_data(mSynth, add_noise=True)
+        dmis = data_misfit.L2DataMisfit(data=dobs, simulation=simulation)
+
+        self.p = simulation
+        self.mesh = mesh
+        self.m0 = mSynth
+        self.survey = survey
+        self.dmis = dmis
+
+    def test_dtype(self):
+        self.assertEqual(self.p.getJ(self.m0).dtype, np.float32)
+
+    def test_misfit(self):
+        # single precision J, so the Taylor errors stop at a larger floor
+        passed = tests.checkDerivative(
+            lambda m: [self.p.dpred(m), lambda mx: self.p.Jvec(self.m0, mx)],
+            self.m0,
+            plotIt=False,
+            num=3,
+            eps=1e-5,
+        )
+        self.assertTrue(passed)
+
+    def test_adjoint(self):
+        v = np.random.rand(self.mesh.nC)
+        w = np.random.rand(self.survey.nD)
+        wtJv = w.dot(self.p.Jvec(self.m0, v))
+        vtJtw = v.dot(self.p.Jtvec(self.m0, w))
+        passed = np.abs(wtJv - vtJtw) < 1e-5 * np.abs(wtJv)
+        print("Adjoint Test", np.abs(wtJv - vtJtw), passed)
+        self.assertTrue(passed)
+
+    def test_dataObj(self):
+        passed = tests.checkDerivative(
+            lambda m: [self.dmis(m), self.dmis.deriv(m)],
+            self.m0,
+            plotIt=False,
+            num=3,
+            eps=1e-5,
+        )
+        self.assertTrue(passed)
+
+
+class IPSimulationCacheTests(unittest.TestCase):
+    def setUp(self):
+
+        aSpacing = 2.5
+        nElecs = 5
+
+        surveySize = nElecs * aSpacing - aSpacing
+        cs = surveySize / nElecs / 4
+
+        mesh = discretize.TensorMesh(
+            [
+                [(cs, 10, -1.3), (cs, surveySize / cs), (cs, 10, 1.3)],
+                [(cs, 3, -1.3), (cs, 3, 1.3)],
+            ],
+            "CN",
+        )
+
+        self.source_list = dc.utils.WennerSrcList(nElecs, aSpacing, in2D=True)
+        self.mesh = mesh
+        self.sigma = np.ones(mesh.nC)
+        self.m0 = np.ones(mesh.nC) * 0.1
+
+    def get_simulation(
+        self, simulation_class=ip.simulation.Simulation3DCellCentered, **kwargs
+    ):
+        survey = ip.survey.Survey(self.source_list)
+        return simulation_class(
+            mesh=self.mesh,
+            survey=survey,
+            sigma=self.sigma,
+            etaMap=maps.IdentityMap(self.mesh),
+            **kwargs
+        )
+
+    def test_dpred_model_update(self):
+        simulation = self.get_simulation()
+        m1 = self.m0
+        m2 = np.random.rand(self.mesh.nC)
+        d1 = simulation.dpred(m1)
+        d2 = simulation.dpred(m2)
+        # the predicted data of m1 must not be reused for m2
+        self.assertFalse(np.allclose(d1, d2))
+        np.testing.assert_allclose(d2, simulation.Jvec(m2, m2))
+
+    def test_dpred_small_model_update(self):
+        # the model update skips the invalidation for allclose models
+        simulation = self.get_simulation()
+        m1 = np.zeros(self.mesh.nC)
+        m2 = np.zeros(self.mesh.nC)
+        m2[self.mesh.nC // 2] = 5e-9
+        self.assertTrue(np.allclose(m1, m2))
+        simulation.dpred(m1)
+        d2 = simulation.dpred(m2)
+        self.assertGreater(np.linalg.norm(d2), 0.0)
+        np.testing.assert_allclose(d2, simulation.Jvec(m2, m2))
+
+    def test_getJtJdiag_without_fields(self):
+        # getJ computes the fields itself on a fresh simulation
+        simulation = self.get_simulation(storeJ=True)
+        diag = simulation.getJtJdiag(self.m0)
+        J = simulation.getJ(self.m0)
+        np.testing.assert_allclose(diag, np.sum(J ** 2, axis=0))
+
+    def test_Jtvec_symmetric_A(self):
+        # the nodal A is pinned at node 0, in the padding where the adjoint
+        # field is negligible, so reusing Ainv is accurate to round off
+        simulations = [
+            self.get_simulation(ip.simulation.Simulation3DNodal) for _ in range(2)
+        ]
+        simulations[1].A_symmetric = False
+        w = np.random.rand(simulations[0].survey.nD)
+        Jtw = [simulation.Jtvec(self.m0, w) for simulation in simulations]
+        self.assertIsNot(simulations[1].ATinv, simulations[1].Ainv)
+        np.testing.assert_allclose(Jtw[0], Jtw[1], rtol=1e-8)
+
+    def test_Jvec_Jtvec_source_blocks(self):
+        # one source per solve bounds the products to (nU, 1) blocks
+        simulations = [
+            self.get_simulation(ip.simulation.Simulation3DNodal) for _ in range(2)
+        ]
+        simulations[1].max_block_columns = 1
+        self.assertGreater(simulations[1].survey.nSrc, 1)
+        v = np.random.rand(self.mesh.nC)
+        w = np.random.rand(simulations[0].survey.nD)
+        Jv = [simulation.Jvec(self.m0, v) for simulation in simulations]
+        Jtw = [simulation.Jtvec(self.m0, w) for simulation in simulations]
+        np.testing.assert_allclose(Jv[0], Jv[1])
+        np.testing.assert_allclose(Jtw[0], Jtw[1])
+
+
 if __name__ == "__main__":
     unittest.main()